@@ -4,6 +4,10 @@ import sys
 import subprocess
 import argparse
 import shutil
+import shlex
+import glob
+import json
+import hashlib
 from datetime import datetime
 
 # --- 1. PROJECT CONFIGURATION ---
@@ -60,17 +64,90 @@ PROJECT_CONFIG = {
 # --- END CONFIGURATION ---
 
 def run_command(command, env=None, capture_output=False, check=True, cwd=None):
-    print(f"--- Running: {command} ---", flush=True)
+    # Argv lists are exec'd directly; strings still go through the shell
+    use_shell = isinstance(command, str)
+    print(f"--- Running: {command if use_shell else shlex.join(command)} ---", flush=True)
     process_env = os.environ.copy()
     if env:
         process_env.update(env)
-    return subprocess.run(command, shell=True, check=check, env=process_env,
+    return subprocess.run(command, shell=use_shell, check=check, env=process_env,
                           capture_output=capture_output, text=True, cwd=cwd)
 
-def get_smart_test_targets(toolkit_dir, project_dir, commit_sha, project_name):
+def resolver_fingerprint(resolver_script):
+    """Content hash of a get_test_targets.py script, or None if it does not exist."""
+    try:
+        with open(resolver_script, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def load_targets_cache(cache_path, fingerprint):
+    """Loads the on-disk smart test target cache ({commit_sha: targets}).
+
+    The cache is dropped when it was written by a different version of the resolver.
+    """
+    if fingerprint is None:
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if not isinstance(data, dict) or data.get("resolver") != fingerprint:
+        print("--- Smart test target cache is stale (resolver changed). Ignoring it. ---")
+        return {}
+    targets = data.get("targets")
+    return targets if isinstance(targets, dict) else {}
+
+def save_targets_cache(cache_path, fingerprint, cache):
+    """Writes the smart test target cache atomically (temp file + rename)."""
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"resolver": fingerprint, "targets": cache}, f)
+    os.replace(tmp_path, cache_path)
+
+def get_project_paths(toolkit_dir, project_name):
+    """Resolves the helper script paths for a project once per run."""
+    helper_dir = os.path.join(toolkit_dir, "helpers", project_name)
+    return {
+        "helper_dir": helper_dir,
+        "build_script": os.path.join(helper_dir, "run_build.sh"),
+        "test_script": os.path.join(helper_dir, "run_tests.sh"),
+        "resolver": os.path.join(helper_dir, "get_test_targets.py"),
+        "dockerfile": os.path.join(helper_dir, "Dockerfile"),
+    }
+
+def get_base_env(config, project_dir, paths):
+    """Builds the env vars shared by every build/test script of a project."""
+    base_env = os.environ.copy()
+    base_env.update({
+        "PROJECT_DIR": project_dir,
+        "BUILDER_IMAGE_TAG": config['builder_tag'],
+        "TOOLKIT_DIR": paths['helper_dir'],  # This points to helpers/jdk8u-dev/ etc.
+    })
+    if config['build_system'] == 'make':
+        base_env["BOOT_JDK"] = config['boot_jdk']
+        base_env["JTREG_HOME"] = config['jtreg_home']
+    return base_env
+
+def resolve_commit_sha(project_dir, commit):
+    """Resolves a commit-ish (SHA, HEAD, branch, tag) to its full SHA, or None if it can't."""
+    try:
+        result = run_command(["git", "rev-parse", "--verify", f"{commit}^{{commit}}"],
+                             capture_output=True, check=True, cwd=project_dir)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return result.stdout.strip()
+
+def get_smart_test_targets(paths, project_dir, commit_sha, targets_cache=None):
     """Calls the project-specific python script to calculate test targets."""
-    resolver_script = os.path.join(toolkit_dir, "helpers", project_name, "get_test_targets.py")
-    
+    # Key the cache on the full SHA so moving refs (HEAD, branches, tags) are never served stale
+    cache_key = resolve_commit_sha(project_dir, commit_sha) if targets_cache is not None else None
+    if cache_key is not None and cache_key in targets_cache:
+        print(f"--- Using cached smart test targets for {cache_key[:7]} ---")
+        return targets_cache[cache_key]
+
+    resolver_script = paths['resolver']
     if not os.path.exists(resolver_script):
         print(f"--- ⚠️ No smart test resolver found at {resolver_script}. Defaulting to ALL. ---")
         return "ALL"
@@ -78,74 +155,109 @@ def get_smart_test_targets(toolkit_dir, project_dir, commit_sha, project_name):
     print(f"--- Calculating smart test targets... ---")
     try:
         result = run_command(
-            f"python3 {resolver_script} --repo {project_dir} --commit {commit_sha}",
+            [sys.executable, resolver_script, "--repo", project_dir, "--commit", commit_sha],
             capture_output=True,
             check=True
         )
         targets = result.stdout.strip()
         if not targets or targets == "NONE":
             print("--- No relevant tests found for this commit. ---")
-            return "NONE"
+            targets = "NONE"
+        if cache_key is not None:
+            targets_cache[cache_key] = targets
         return targets
-    except Exception as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"--- ❌ Error calculating test targets: {e}. Fallback to ALL. ---")
         return "ALL"
 
-def run_tests(config, toolkit_dir, project_dir, commit_sha, build_type, results_dir, test_strategy):
+def resolve_test_targets(test_strategy, paths, project_dir, commit_sha, targets_cache, targets_cache_path, resolver_fp):
+    """Resolves the test targets for commit_sha ("ALL" unless the strategy is smart).
+
+    Resolvers inspect the working tree (e.g. which modules have a pom.xml), so this must
+    only be called while commit_sha is checked out, i.e. after its build has run.
+    """
+    if test_strategy != "smart":
+        return "ALL"
+    cached_count = len(targets_cache) if targets_cache is not None else 0
+    test_targets = get_smart_test_targets(paths, project_dir, commit_sha, targets_cache)
+    if targets_cache is not None and len(targets_cache) > cached_count:
+        save_targets_cache(targets_cache_path, resolver_fp, targets_cache)
+    return test_targets
+
+def run_tests(config, toolkit_dir, paths, base_env, commit_sha, build_type, results_dir, test_strategy, test_targets):
     """Orchestrates the testing process."""
+    if test_targets == "NONE":
+        print(f"--- No relevant tests, skipping {build_type} test run. ---")
+        return "Skipped (No relevant tests)"
+
     print(f"\n{'='*80}")
     print(f"--- Starting Tests ({test_strategy.upper()}) for {config['repo_name']} ({build_type}) ---")
     print(f"{'='*80}")
 
-    test_targets = "ALL"
-    if test_strategy == "smart":
-        test_targets = get_smart_test_targets(toolkit_dir, project_dir, commit_sha, config['repo_name'])
-    
-    if test_targets == "NONE":
-        return "Skipped (No relevant tests)"
-
     print(f"--- Test Targets: {test_targets} ---")
 
-    test_env = os.environ.copy()
-    # This points to helpers/jdk8u-dev/ etc.
-    project_helper_dir = os.path.join(toolkit_dir, "helpers", config['repo_name'])
-    
+    test_env = base_env.copy()
     test_env.update({
         "COMMIT_SHA": commit_sha,
-        "PROJECT_DIR": project_dir,
         "TEST_TARGETS": test_targets,
-        "BUILDER_IMAGE_TAG": config['builder_tag'],
-        "TOOLKIT_DIR": project_helper_dir  # <--- THIS WAS MISSING
     })
     
     # Add build-system specific env vars
-    if config['build_system'] == 'make':
-        test_env["BOOT_JDK"] = config['boot_jdk']
-        test_env["JTREG_HOME"] = config['jtreg_home']
-        test_env["BUILD_DIR_NAME"] = f"build_output_{commit_sha[:7]}_{build_type}"
+    test_env_extra = TEST_ENV_EXTRA.get(config['build_system'])
+    if test_env_extra:
+        test_env.update(test_env_extra(config, commit_sha, build_type, results_dir))
 
-    elif config['build_system'] == 'self-building':
-        test_env["BUILD_TYPE"] = build_type
-
-    run_tests_script = os.path.join(project_helper_dir, "run_tests.sh")
+    run_tests_script = paths['test_script']
     if not os.path.exists(run_tests_script):
         print(f"--- ❌ Error: {run_tests_script} not found. ---")
         return "Fail (Missing Script)"
 
     start_time = datetime.now()
     try:
-        run_command(f"bash {run_tests_script}", env=test_env, check=True, cwd=toolkit_dir)
+        run_command(["bash", run_tests_script], env=test_env, check=True, cwd=toolkit_dir)
         status = "Success"
     except subprocess.CalledProcessError:
         status = "Fail (Tests Failed)"
-    except Exception as e:
+    except OSError as e:
         status = f"Fail (Error: {e})"
     
     duration = (datetime.now() - start_time).total_seconds()
     print(f"--- Test run finished: {status} ({duration:.2f}s) ---")
     return status
 
-def build_single_commit(config, toolkit_dir, project_dir, commit_sha, build_type, results_dir):
+def commit_image_tag(config, commit_sha, build_type):
+    """Tag of the per-commit image, e.g. elasticsearch-fixed-abc1234."""
+    return f"{config['repo_name']}-{build_type}-{commit_sha[:7]}"
+
+def make_project_env(config, commit_sha, build_type, results_dir):
+    # Out-of-tree build dir for make (JDK) projects, shared by build and test
+    return {"BUILD_DIR_NAME": f"build_output_{commit_sha[:7]}_{build_type}"}
+
+def self_building_build_env(config, commit_sha, build_type, results_dir):
+    return {
+        "IMAGE_TAG": commit_image_tag(config, commit_sha, build_type),
+        "BUILD_DIR": os.path.join(results_dir, f"{build_type}_run", "build_output"),
+    }
+
+def self_building_test_env(config, commit_sha, build_type, results_dir):
+    return {"BUILD_TYPE": build_type}
+
+def builder_image_build_env(config, commit_sha, build_type, results_dir):
+    return {"IMAGE_TAG_TO_BUILD": commit_image_tag(config, commit_sha, build_type)}
+
+# Per build-system env vars added on top of the base env, keyed by config['build_system']
+BUILD_ENV_EXTRA = {
+    "make": make_project_env,
+    "self-building": self_building_build_env,
+    "gradle": builder_image_build_env,
+    "maven": builder_image_build_env,
+}
+TEST_ENV_EXTRA = {
+    "make": make_project_env,
+    "self-building": self_building_test_env,
+}
+
+def build_single_commit(config, toolkit_dir, paths, base_env, commit_sha, build_type, results_dir):
     """Builds a single commit (fixed or buggy)."""
     short_sha = commit_sha[:7]
     print(f"\n{'='*80}")
@@ -153,39 +265,31 @@ def build_single_commit(config, toolkit_dir, project_dir, commit_sha, build_type
     print(f"{'='*80}")
     
     status_file = os.path.join(results_dir, f"{build_type}_build_status.txt")
-    project_helper_dir = os.path.join(toolkit_dir, "helpers", config['repo_name'])
 
-    build_env = os.environ.copy()
+    build_env = base_env.copy()
     build_env.update({
         "COMMIT_SHA": commit_sha,
-        "BUILDER_IMAGE_TAG": config['builder_tag'],
         "BUILD_STATUS_FILE": status_file,
-        "PROJECT_DIR": project_dir,
-        "TOOLKIT_DIR": project_helper_dir,
     })
 
-    if config['build_system'] == 'make':
-        build_env["BUILD_DIR_NAME"] = f"build_output_{short_sha}_{build_type}"
-        build_env["BOOT_JDK"] = config['boot_jdk']
-        build_env["JTREG_HOME"] = config['jtreg_home']
-    elif config['build_system'] == 'self-building':
-        build_env["IMAGE_TAG"] = f"{config['repo_name']}-{build_type}-{short_sha}"
-        build_env["BUILD_DIR"] = os.path.join(results_dir, f"{build_type}_run", "build_output")
-        os.makedirs(build_env["BUILD_DIR"], exist_ok=True)
-    elif config['build_system'] in ['gradle', 'maven']:
-        build_env["IMAGE_TAG_TO_BUILD"] = f"{config['repo_name']}-{build_type}-{short_sha}"
+    # Add build-system specific env vars
+    build_env_extra = BUILD_ENV_EXTRA[config['build_system']](config, commit_sha, build_type, results_dir)
+    build_env.update(build_env_extra)
+    # Self-building projects mount BUILD_DIR into the container, so it must exist up front
+    if "BUILD_DIR" in build_env_extra:
+        os.makedirs(build_env_extra["BUILD_DIR"], exist_ok=True)
 
     build_status = "Fail (Script Error)"
     start_time = datetime.now()
     
     try:
-        run_command(f"bash {project_helper_dir}/run_build.sh", env=build_env, check=True, cwd=toolkit_dir)
+        run_command(["bash", paths['build_script']], env=build_env, check=True, cwd=toolkit_dir)
         try:
             with open(status_file, 'r') as f:
                 build_status = f.read().strip()
         except FileNotFoundError:
             build_status = "Fail (Status file not found)"
-    except Exception as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"--- ❌ BUILD ERROR: {e} ---")
         build_status = "Fail (Error)"
     
@@ -194,6 +298,28 @@ def build_single_commit(config, toolkit_dir, project_dir, commit_sha, build_type
     print(f"--- Build complete: {build_status} ({build_time:.2f}s) ---")
     return build_status, build_time
 
+def run_cleanup_step(command):
+    """Runs a best-effort cleanup command; failures, including a missing binary, are only logged."""
+    try:
+        run_command(command, check=False, capture_output=True)
+    except OSError as e:
+        print(f"--- ⚠️ Cleanup step failed: {e} ---")
+
+def cleanup(project_dir, commit_images):
+    """Removes build outputs and per-commit images in one pass at the end of a run."""
+    print("\n--- Cleaning up... ---")
+    build_output_dirs = glob.glob(os.path.join(project_dir, "build_output_*"))
+    if build_output_dirs:
+        # Build outputs are written as root by the containers; sudo is unnecessary (and often
+        # absent) when we already run as root, e.g. inside a container
+        use_sudo = os.geteuid() != 0 and shutil.which("sudo") is not None
+        rm_command = ["sudo", "rm", "-rf"] if use_sudo else ["rm", "-rf"]
+        run_cleanup_step([*rm_command, *build_output_dirs])
+    if commit_images:
+        run_cleanup_step(["docker", "image", "rm", "-f", *commit_images])
+    # Only prune stale build cache; a full prune evicts the layers the next run reuses
+    run_cleanup_step(["docker", "builder", "prune", "--filter", "until=24h", "-f"])
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--project", required=True, choices=PROJECT_CONFIG.keys())
@@ -206,6 +332,8 @@ def main():
                         help="Which commit to test (default: fixed)")
     parser.add_argument("--test-strategy", choices=['smart', 'all'], default='smart',
                         help="smart: affected modules only (default), all: full suite")
+    parser.add_argument("--no-target-cache", action="store_true",
+                        help="Always re-run the smart test resolver instead of using cached targets")
     
     args = parser.parse_args()
 
@@ -224,40 +352,80 @@ def main():
         print(f"FATAL: Repo not found at {PROJECT_DIR}")
         sys.exit(1)
 
+    # Paths and env vars that are fixed for the whole run
+    paths = get_project_paths(TOOLKIT_DIR, config['repo_name'])
+    base_env = get_base_env(config, PROJECT_DIR, paths)
+
+    # Smart test targets are cached per project across runs, keyed by commit and
+    # invalidated whenever the project's get_test_targets.py changes
+    targets_cache = None
+    targets_cache_path = os.path.join(TOOLKIT_DIR, "build_results", PROJECT_NAME, "test_targets_cache.json")
+    resolver_fp = resolver_fingerprint(paths['resolver'])
+    if args.run_tests and args.test_strategy == "smart" and not args.no_target_cache:
+        targets_cache = load_targets_cache(targets_cache_path, resolver_fp)
+
     # Build Builder Image
     if config['build_system'] != 'self-building':
-        dockerfile = os.path.join(TOOLKIT_DIR, "helpers", PROJECT_NAME, "Dockerfile")
-        run_command(f"docker build -t {config['builder_tag']} -f {dockerfile} {os.path.dirname(dockerfile)}")
+        # BuildKit reuses builder layers from its local cache (only pruned by age in cleanup).
+        # No --pull: base images use floating tags (e.g. eclipse-temurin:17-jdk), and refreshing
+        # them mid-sweep would change the toolchain between commits and cost a registry round-trip.
+        dockerfile = paths['dockerfile']
+        run_command(["docker", "build", "-t", config['builder_tag'], "-f", dockerfile, os.path.dirname(dockerfile)],
+                    env={"DOCKER_BUILDKIT": "1"})
+
+    # Per-commit images built by self-building projects, removed during cleanup
+    commit_images = []
 
-    # --- 1. Build & Test AFTER ---
-    after_status, after_time = build_single_commit(config, TOOLKIT_DIR, PROJECT_DIR, COMMIT_SHA, "fixed", RESULTS_DIR)
-    after_test_status = "Skipped"
+    try:
+        # --- 1. Build & Test AFTER ---
+        if config['build_system'] == 'self-building':
+            commit_images.append(commit_image_tag(config, COMMIT_SHA, "fixed"))
+        after_status, after_time = build_single_commit(config, TOOLKIT_DIR, paths, base_env, COMMIT_SHA, "fixed", RESULTS_DIR)
+        after_test_status = "Skipped"
     
-    # Logic: Run tests if --run-tests IS SET AND target is 'fixed' or 'both'
-    if after_status == "Success" and args.run_tests and args.test_target in ['fixed', 'both']:
-        after_test_status = run_tests(config, TOOLKIT_DIR, PROJECT_DIR, COMMIT_SHA, "fixed", RESULTS_DIR, args.test_strategy)
+        # Logic: Run tests if --run-tests IS SET AND target is 'fixed' or 'both'
+        if after_status == "Success" and args.run_tests and args.test_target in ['fixed', 'both']:
+            # Resolved only now, while the fixed build's checkout of COMMIT_SHA is in place
+            after_targets = resolve_test_targets(args.test_strategy, paths, PROJECT_DIR, COMMIT_SHA,
+                                                 targets_cache, targets_cache_path, resolver_fp)
+            after_test_status = run_tests(config, TOOLKIT_DIR, paths, base_env, COMMIT_SHA, "fixed", RESULTS_DIR, args.test_strategy, after_targets)
 
-    # --- 2. Build & Test BEFORE ---
-    before_status = "Skipped"
-    before_test_status = "Skipped"
+        # --- 2. Build & Test BEFORE ---
+        before_status = "Skipped"
+        before_test_status = "Skipped"
     
-    if args.build_before:
-        # Only attempt before build if after build succeeded (save time)
-        if after_status == "Success":
-            parent_commit = run_command(f"git rev-parse {COMMIT_SHA}^", capture_output=True, cwd=PROJECT_DIR).stdout.strip()
-            before_status, before_time = build_single_commit(config, TOOLKIT_DIR, PROJECT_DIR, parent_commit, "buggy", RESULTS_DIR)
-            
-            # Logic: Run tests if --run-tests IS SET AND target is 'buggy' or 'both'
-            if before_status == "Success" and args.run_tests and args.test_target in ['buggy', 'both']:
-                before_test_status = run_tests(config, TOOLKIT_DIR, PROJECT_DIR, parent_commit, "buggy", RESULTS_DIR, args.test_strategy)
-        else:
-            print("--- Skipping Before build because After build failed. ---")
-            before_status = "Skipped (After Failed)"
-
-    # --- Cleanup ---
-    print("\n--- Cleaning up... ---")
-    run_command(f"sudo rm -rf {PROJECT_DIR}/build_output_*", check=False, capture_output=True)
-    run_command("docker builder prune -a -f", check=False, capture_output=True)
+        if args.build_before:
+            # Only attempt before build if after build succeeded (save time)
+            if after_status == "Success":
+                try:
+                    parent_commit = run_command(["git", "rev-parse", f"{COMMIT_SHA}^"], capture_output=True, cwd=PROJECT_DIR).stdout.strip()
+                except subprocess.CalledProcessError as e:
+                    print(f"--- ❌ Could not resolve parent of {COMMIT_SHA}: {e.stderr.strip()} ---")
+                    parent_commit = None
+
+                if parent_commit is None:
+                    before_status = "Skipped (No Parent)"
+                else:
+                    if config['build_system'] == 'self-building':
+                        commit_images.append(commit_image_tag(config, parent_commit, "buggy"))
+                    before_status, before_time = build_single_commit(config, TOOLKIT_DIR, paths, base_env, parent_commit, "buggy", RESULTS_DIR)
+
+                    # Logic: Run tests if --run-tests IS SET AND target is 'buggy' or 'both'
+                    if before_status == "Success" and args.run_tests and args.test_target in ['buggy', 'both']:
+                        # Resolved only now, while the buggy build's checkout of the parent is in place
+                        before_targets = resolve_test_targets(args.test_strategy, paths, PROJECT_DIR, parent_commit,
+                                                              targets_cache, targets_cache_path, resolver_fp)
+                        before_test_status = run_tests(config, TOOLKIT_DIR, paths, base_env, parent_commit, "buggy", RESULTS_DIR, args.test_strategy, before_targets)
+            else:
+                print("--- Skipping Before build because After build failed. ---")
+                before_status = "Skipped (After Failed)"
+    finally:
+        # --- Cleanup (also runs if a build/test step raised or was interrupted) ---
+        # Best-effort: a cleanup failure must not mask the original error or skip the report
+        try:
+            cleanup(PROJECT_DIR, commit_images)
+        except OSError as e:
+            print(f"--- ⚠️ Cleanup failed: {e} ---")
 
     # --- Report ---
     print("\n" + "="*80)
@@ -266,11 +434,13 @@ def main():
     print(f"Before: Build={before_status}, Test={before_test_status}")
     print("="*80)
     
-    # Save report
-    with open(final_report_path, "w") as f:
+    # Save report (write to a temp file and rename so a crash never leaves a partial report)
+    tmp_report_path = final_report_path + ".tmp"
+    with open(tmp_report_path, "w") as f:
         f.write(f"Project: {PROJECT_NAME}\nCommit: {COMMIT_SHA}\n")
         f.write(f"After Build: {after_status}\nAfter Test: {after_test_status}\n")
         f.write(f"Before Build: {before_status}\nBefore Test: {before_test_status}\n")
+    os.replace(tmp_report_path, final_report_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -13,7 +13,7 @@ git checkout ${COMMIT_SHA}
 echo "--- Building Docker image... ---"
 # -f points to the Dockerfile in our toolkit
 # . (the context) is the PROJECT_DIR we just cd'd into
-docker build -t ${IMAGE_TAG} -f ${TOOLKIT_DIR}/Dockerfile .
+DOCKER_BUILDKIT=1 docker build -t ${IMAGE_TAG} -f ${TOOLKIT_DIR}/Dockerfile .
 
 echo "--- Setting cache permissions... ---"
 docker run --rm -u root \